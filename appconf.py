@@ -1,8 +1,25 @@
+import hashlib
+import io
+import os
+import pickle
+import stat
 import sys
-from collections import defaultdict
+import tempfile
+from dataclasses import dataclass, field
+from functools import lru_cache
 
 import yaml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 
 _GZIP_TYPES = [
     'text/plain', 'text/xml', 'text/css', 'application/x-javascript', 'application/javascript',
@@ -20,6 +37,9 @@ _HTTPS_HEADERS = {
 }
 _HTTPS_HEADERS.update(_HTTP_HEADERS)
 
+_HTTP_HEADER_LINES = tuple(('add_header', name, value, 'always') for name, value in _HTTP_HEADERS.items())
+_HTTPS_HEADER_LINES = tuple(('add_header', name, value, 'always') for name, value in _HTTPS_HEADERS.items())
+
 _TLS_CIPHERS = [
     'ECDHE-RSA-CHACHA20-POLY1305',
     'ECDHE-RSA-AES256-GCM-SHA512',
@@ -32,6 +52,9 @@ _TLS_CIPHERS = [
     'ECDHE-RSA-AES128-SHA256',
 ]
 
+_GZIP_TYPES_STR = ' '.join(_GZIP_TYPES)
+_TLS_CIPHERS_STR = ':'.join(_TLS_CIPHERS)
+
 _NGINX_GLOBALS = [
     ('#', 'Auto-generated by Zombie Nginx configurator'),
     ('user', 'nginx'),
@@ -62,7 +85,7 @@ _NGINX_HTTP = [
     ('gzip', 'on'),
     ('gzip_min_length', '1000'),
     ('gzip_static', 'on'),
-    ('gzip_types', *_GZIP_TYPES),
+    ('gzip_types', _GZIP_TYPES_STR),
     ('gzip_vary', 'on'),
 
     ('sendfile', 'on'),
@@ -80,6 +103,27 @@ _NGINX_HTTP = [
 ]
 
 
+_SSL_OPTIONS = (
+    ('ssl_protocols', 'TLSv1.2'),
+
+    ('ssl_prefer_server_ciphers', 'on'),
+    ('ssl_ciphers', _TLS_CIPHERS_STR),
+    ('ssl_dhparam', '/etc/ssl/dhparam-2048.pem'),
+
+    ('ssl_session_timeout', '1d'),
+    ('ssl_session_cache', 'shared:SSL:50m'),
+    ('ssl_session_tickets', 'off'),
+
+    ('ssl_stapling', 'on'),
+    ('ssl_stapling_verify', 'on'),
+    ('resolver', '8.8.8.8 8.8.4.4', 'valid=300s'),
+    ('resolver_timeout', '5s'),
+)
+
+# Body of the strict host check; one list shared by every memoized base_config_* result, so it must not be mutated.
+_HOST_MISMATCH_BLOCK = [('return', '444')]
+
+
 def _base_config_http_common(server_name, strict_host, use_syscall_flags=False):
     """
     The `use_syscall_flags = True` can be used only once. Quoting Nginx documentation: The listen directive can have
@@ -91,71 +135,74 @@ def _base_config_http_common(server_name, strict_host, use_syscall_flags=False):
     - http://nginx.org/en/docs/http/ngx_http_core_module.html#listen
     """
     syscall_flags = ('deferred', 'reuseport') if use_syscall_flags else ()
-    config = [
+    config = (
         ('listen', '80') + syscall_flags,
         ('listen', '[::]:80') + syscall_flags,
         ('server_name', server_name),
-    ]
+    )
     if strict_host:
         regex_server_name = '|'.join(server_name.split(' '))
-        config.append(('if', f'($http_host !~* ^{regex_server_name}$)', [('return', '444')]))
+        config += (('if', '($http_host !~* ^%s$)' % regex_server_name, _HOST_MISMATCH_BLOCK),)
     return config
 
 
+# The base_config_* functions are called once per server, so their memoization only pays off when server names repeat.
+# They return shared tuples, which callers must copy rather than mutate.
+@lru_cache(maxsize=None)
 def base_config_https_redirect(server_name, strict_host, use_syscall_flags=False):
-    return _base_config_http_common(server_name, strict_host, use_syscall_flags) + [
-        ('return', '301', 'https://$http_host$request_uri')
-    ]
+    return _base_config_http_common(server_name, strict_host, use_syscall_flags) + (
+        ('return', '301', 'https://$http_host$request_uri'),
+    )
 
 
+@lru_cache(maxsize=None)
 def base_config_http(server_name, strict_host, use_syscall_flags=False):
-    return _base_config_http_common(server_name, strict_host, use_syscall_flags) + [
-        ('add_header', name, value, 'always') for name, value in _HTTP_HEADERS.items()
-    ]
+    return _base_config_http_common(server_name, strict_host, use_syscall_flags) + _HTTP_HEADER_LINES
 
 
+@lru_cache(maxsize=None)
 def base_config_https(server_name, strict_host, use_syscall_flags=False):
     """
     Info about `use_syscall_flags` in `_base_config_http_common()` function.
     """
     syscall_flags = ('deferred', 'reuseport') if use_syscall_flags else ()
-    regex_server_name = '|'.join(server_name.split(' '))
-    return [
+    config = [
         ('listen', '443', 'ssl', 'http2') + syscall_flags,
         ('listen', '[::]:443', 'ssl', 'http2') + syscall_flags,
         ('server_name', server_name),
-    ] + ([('if', f'($http_host !~* ^{regex_server_name}$)', [('return', '444')])] if strict_host else []) + [
-        ('add_header', name, value, 'always') for name, value in _HTTPS_HEADERS.items()
-    ] + [
-        ('ssl_protocols', 'TLSv1.2'),
-
-        ('ssl_prefer_server_ciphers', 'on'),
-        ('ssl_ciphers', ':'.join(_TLS_CIPHERS)),
-        ('ssl_dhparam', '/etc/ssl/dhparam-2048.pem'),
-
-        ('ssl_session_timeout', '1d'),
-        ('ssl_session_cache', 'shared:SSL:50m'),
-        ('ssl_session_tickets', 'off'),
-
-        ('ssl_stapling', 'on'),
-        ('ssl_stapling_verify', 'on'),
-        ('resolver', '8.8.8.8 8.8.4.4', 'valid=300s'),
-        ('resolver_timeout', '5s'),
     ]
+    if strict_host:
+        regex_server_name = '|'.join(server_name.split(' '))
+        config.append(('if', '($http_host !~* ^%s$)' % regex_server_name, _HOST_MISMATCH_BLOCK))
+    config.extend(_HTTPS_HEADER_LINES)
+    config.extend(_SSL_OPTIONS)
+    return tuple(config)
 
 
-def emit_nginx_conf(config, *, indent=0):
-    white = ' ' * indent
-    for item in config:
-        if isinstance(item[-1], list):
-            print(white)
-            print(white + ' '.join(item[0:-1]) + ' {')
-            emit_nginx_conf(item[-1], indent=indent + 2)
-            print(white + '}')
-        elif item[0] == '#':
-            print(white + ' '.join(item))
+def emit_nginx_conf(config, out, *, indent=0):
+    """
+    Writes rendered `config` to the `out` text stream, e.g. an `io.StringIO` that can be flushed in one go.
+    Nested blocks are walked with an explicit stack of (items iterator, indentation) pairs instead of recursion.
+    """
+    write = out.write
+    join = ' '.join
+    stack = [(iter(config), ' ' * indent)]
+    while stack:
+        items, white = stack[-1]
+        for item in items:
+            if isinstance(item[-1], list):
+                write(white + '\n')
+                write(white + join(item[0:-1]) + ' {\n')
+                stack.append((iter(item[-1]), white + '  '))
+                break
+            elif item[0] == '#':
+                write(white + join(item) + '\n')
+            else:
+                write(white + join(item) + ';\n')
         else:
-            print(white + ' '.join(item) + ';')
+            stack.pop()
+            if stack:
+                write(stack[-1][1] + '}\n')
 
 
 def generate_static_files_entry(description):
@@ -188,42 +235,49 @@ def generate_static_files(description):
     return [generate_static_files_entry(item) for item in description]
 
 
+@dataclass
+class Upstream:
+    __slots__ = ('name', 'location', 'url', 'type', 'upstream_raw_options')
+    name: str
+    location: str
+    url: str
+    type: str
+    upstream_raw_options: list
+
+
+_URL_PROTOS = (('http://', 'http'), ('uwsgi://', 'uwsgi'))
+
 _upstream_counter = 0
 
 
 def parse_single_upstream(server_name, config):
+    """
+    Returns an `Upstream`, with the protocol prefix stripped from its `url`.
+    """
     if isinstance(config, str):
-        config = {
-            'url': config,
-            'name': f'{server_name}-upstream',
-            'location': '/'
-        }
-    elif 'name' not in config:
-        global _upstream_counter
-        _upstream_counter += 1
-        config['name'] = f'upstream-auto-{_upstream_counter}'
-
-    upstream = {
-        'name': config['name'],
-        'location': config['location'],
-    }
-
-    upstream_raw_options = config.get('upstream_raw_options', [])
-    if upstream_raw_options:
-        if not isinstance(upstream_raw_options, list):
+        name, location, url, upstream_raw_options = sys.intern(f'{server_name}-upstream'), '/', config, []
+    else:
+        if 'name' in config:
+            name = config['name']
+        else:
+            global _upstream_counter
+            _upstream_counter += 1
+            name = sys.intern(f'upstream-auto-{_upstream_counter}')
+        location = config['location']
+        upstream_raw_options = config.get('upstream_raw_options', [])
+        if upstream_raw_options and not isinstance(upstream_raw_options, list):
             raise Exception(f'{server_name}.upstream_raw_options must be an array')
-        upstream.update(upstream_raw_options=upstream_raw_options)
+        url = config['url']
 
-    for proto in 'http', 'uwsgi':
-        if config['url'].startswith(f'{proto}://'):
-            upstream.update(url=config['url'][len(proto) + 3:], type=proto)
-            return upstream
+    for prefix, proto in _URL_PROTOS:
+        if url.startswith(prefix):
+            return Upstream(name, location, url[len(prefix):], proto, upstream_raw_options)
     raise Exception(f'Please prefix {server_name}.upstream url with protocol name')
 
 
 def parse_upstreams(input_config):
     upstreams = []
-    configs = defaultdict(list)
+    configs = {}
     for server_name, server_config in input_config.get('servers', {}).items():
         if 'upstream' not in server_config:
             continue
@@ -233,23 +287,31 @@ def parse_upstreams(input_config):
             config = [config]
         for entry in config:
             upstream = parse_single_upstream(server_name, entry)
-            upstreams.append(('upstream', upstream['name'], [
-                ('server', upstream['url']),
+            upstreams.append(('upstream', upstream.name, [
+                ('server', upstream.url),
             ]))
-            configs[server_name].append(upstream)
+            configs.setdefault(server_name, []).append(upstream)
     return upstreams, configs
 
 
-def generate_tls_config(cert):
-    config = [
-        ('ssl_certificate', f'/etc/nginx/certs/{cert["certificate"]}'),
-        ('ssl_certificate_key', f'/etc/nginx/certs/{cert["key"]}'),
-    ]
-    if 'root_chain' in cert:
-        config.append(('ssl_trusted_certificate', f'/etc/nginx/certs/{cert["root_chain"]}'))
+@lru_cache(maxsize=None)
+def _generate_tls_config_cached(certificate, key, root_chain):
+    config = (
+        ('ssl_certificate', f'/etc/nginx/certs/{certificate}'),
+        ('ssl_certificate_key', f'/etc/nginx/certs/{key}'),
+    )
+    if root_chain is not None:
+        config += (('ssl_trusted_certificate', f'/etc/nginx/certs/{root_chain}'),)
     return config
 
 
+def generate_tls_config(cert):
+    """
+    Servers sharing a certificate get the same memoized tuple, which callers must not mutate.
+    """
+    return _generate_tls_config_cached(cert['certificate'], cert['key'], cert.get('root_chain'))
+
+
 def activate_lets_encrypt(server_name):
     server_names = server_name.split(' ')
     with open('/tmp/le-domain.txt', 'a') as f:
@@ -263,53 +325,87 @@ def activate_lets_encrypt(server_name):
     }
 
 
+@dataclass
+class _ServerState:
+    server_name: str = None
+    tls: object = None
+    check_host_header: bool = True
+    extra_config: list = field(default_factory=list)
+    use_syscall_flags_in_http: bool = False
+    use_syscall_flags_in_https: bool = False
+
+
+def _handle_server_raw_options(state, name, content):
+    if not isinstance(content, list):
+        raise Exception(f'{name}.server_raw_options must be an array')
+    for option in content:
+        state.extra_config.append(option.split(' '))
+
+
+def _handle_server_name(state, name, content):
+    state.server_name = content
+
+
+def _handle_static_files(state, name, content):
+    state.extra_config.extend(generate_static_files(content))
+
+
+def _handle_tls(state, name, content):
+    state.tls = content
+
+
+def _handle_check_host_header(state, name, content):
+    if not isinstance(content, bool):
+        raise Exception(f'{name}.check_host_header must be a boolean value')
+    state.check_host_header = content
+
+
+def _handle_upstream(state, name, content):
+    pass  # handled by parse_upstreams
+
+
+def _handle_first_http_server(state, name, content):
+    state.use_syscall_flags_in_http = True
+
+
+def _handle_first_https_server(state, name, content):
+    state.use_syscall_flags_in_https = True
+
+
+_SERVER_OPTION_HANDLERS = {
+    'server_raw_options': _handle_server_raw_options,
+    'server_name': _handle_server_name,
+    'static_files': _handle_static_files,
+    'tls': _handle_tls,
+    'check_host_header': _handle_check_host_header,
+    'upstream': _handle_upstream,
+    'first_http_server': _handle_first_http_server,
+    'first_https_server': _handle_first_https_server,
+}
+
+
 def generate_server(name, description, upstreams):
-    server_name = None
-    tls = None
-    check_host_header = True
-    extra_config = []
-    use_syscall_flags_in_http = False
-    use_syscall_flags_in_https = False
+    state = _ServerState()
     for item, content in description.items():
-        if item == 'server_raw_options':
-            if not isinstance(content, list):
-                raise Exception(f'{name}.server_raw_options must be an array')
-            for option in content:
-                extra_config.append(option.split(' '))
-        elif item == 'server_name':
-            server_name = content
-        elif item == 'static_files':
-            extra_config.extend(generate_static_files(content))
-        elif item == 'tls':
-            tls = content
-        elif item == 'check_host_header':
-            if not isinstance(content, bool):
-                raise Exception(f'{name}.check_host_header must be a boolean value')
-            check_host_header = content
-        elif item == 'upstream':
-            pass  # handled by parse_upstreams
-        elif item == 'first_http_server':
-            use_syscall_flags_in_http = item
-        elif item == 'first_https_server':
-            use_syscall_flags_in_https = item
-        else:
+        handler = _SERVER_OPTION_HANDLERS.get(item)
+        if handler is None:
             raise Exception(f'unknown option {name}.{item}')
-
-    if not server_name:
+        handler(state, name, content)
+    if not state.server_name:
         raise Exception('server_name is required')
 
     use_tls = True
-    if tls is False:
+    if state.tls is False:
         use_tls = False
-    elif isinstance(tls, str) and tls == 'auto':
-        cert = activate_lets_encrypt(server_name)
-        extra_config.extend(generate_tls_config(cert))
-        extra_config.append(('location', '/.well-known/acme-challenge', [('root', '/var/www/letsencrypt')]))
-    elif isinstance(tls, dict):
-        extra_config.extend(generate_tls_config(tls))
-    elif isinstance(tls, list):
-        for cert in tls:
-            extra_config.extend(generate_tls_config(cert))
+    elif isinstance(state.tls, str) and state.tls == 'auto':
+        cert = activate_lets_encrypt(state.server_name)
+        state.extra_config.extend(generate_tls_config(cert))
+        state.extra_config.append(('location', '/.well-known/acme-challenge', [('root', '/var/www/letsencrypt')]))
+    elif isinstance(state.tls, dict):
+        state.extra_config.extend(generate_tls_config(state.tls))
+    elif isinstance(state.tls, list):
+        for cert in state.tls:
+            state.extra_config.extend(generate_tls_config(cert))
     else:
         raise Exception(f'{name}.tls value is invalid')
 
@@ -320,29 +416,30 @@ def generate_server(name, description, upstreams):
             ('proxy_set_header', 'Host', '$http_host'),
         ]
 
-        for option in upstream.get('upstream_raw_options', []):
+        for option in upstream.upstream_raw_options:
             config.append(option.split(' '))
-        if upstream['type'] == 'uwsgi':
+        if upstream.type == 'uwsgi':
             config.append(('include', 'uwsgi_params'))
-            config.append(('uwsgi_pass', upstream['name']))
-        elif upstream['type'] == 'http':
-            config.append(('proxy_pass', f'http://{upstream["name"]}'))
+            config.append(('uwsgi_pass', upstream.name))
+        elif upstream.type == 'http':
+            config.append(('proxy_pass', f'http://{upstream.name}'))
         else:
-            raise NotImplementedError(f'Someone was naughty and did not implement the {upstream["type"]} upstream type')
-        extra_config.append(('location', upstream['location'], config))
+            raise NotImplementedError(f'Someone was naughty and did not implement the {upstream.type} upstream type')
+        state.extra_config.append(('location', upstream.location, config))
 
     servers = []
     if use_tls:
+        redirect_config = base_config_https_redirect(
+            state.server_name, state.check_host_header, state.use_syscall_flags_in_http)
         servers.append(('server', [
             ('#', name, '- force HTTPS'),
-        ] + base_config_https_redirect(server_name, check_host_header, use_syscall_flags_in_http)))
-        servers.append(('server', [
-            ('#', name),
-        ] + base_config_https(server_name, check_host_header, use_syscall_flags_in_https) + extra_config))
+        ] + list(redirect_config)))
+        base_config = base_config_https(state.server_name, state.check_host_header, state.use_syscall_flags_in_https)
     else:
-        servers.append(('server', [
-            ('#', name),
-        ] + base_config_http(server_name, check_host_header, use_syscall_flags_in_http) + extra_config))
+        base_config = base_config_http(state.server_name, state.check_host_header, state.use_syscall_flags_in_http)
+    servers.append(('server', [
+        ('#', name),
+    ] + list(base_config) + state.extra_config))
     return servers
 
 
@@ -373,26 +470,121 @@ def generate_servers(app_conf, upstreams):
 
 def generate_http(app_conf):
     http = _NGINX_HTTP.copy()
+    idx_by_key = {}
+    for idx, option in enumerate(http):
+        idx_by_key.setdefault(option[0], idx)
     for entry in app_conf.get('http_raw_options', []):
         parts = entry.split(' ')
         if parts[0] == 'include':
             http.append(parts)
             continue
-        for idx, option in enumerate(http):
-            if option[0] == parts[0]:
-                http[idx] = parts
-                break
+        idx = idx_by_key.get(parts[0])
+        if idx is not None:
+            http[idx] = parts
         else:
+            idx_by_key[parts[0]] = len(http)
             http.append(parts)
     return http
 
 
+def _contains_float(value):
+    if isinstance(value, float):
+        return True
+    if isinstance(value, dict):
+        return any(_contains_float(item) for item in value.values())
+    if isinstance(value, list):
+        return any(_contains_float(item) for item in value)
+    return False
+
+
+def parse_app_conf(data):
+    """
+    Configs written as JSON are parsed with orjson (when installed) instead of PyYAML. PyYAML resolves scalars by
+    YAML 1.1 rules, under which some JSON numbers are not floats (e.g. `1e3` is the string `'1e3'`), so documents
+    containing any float still go through PyYAML to parse the same whether or not orjson is available.
+    """
+    if orjson is not None:
+        try:
+            app_conf = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+        else:
+            if not _contains_float(app_conf):
+                return app_conf
+    return yaml.load(data, Loader=_YamlLoader)
+
+
+_PARSE_CACHE_DIR = '/tmp/zombie-nginx-parse-cache'
+
+
+def _parse_cache_dir_is_trusted():
+    """
+    The cache lives in world-writable `/tmp` and is read with `pickle`, so it is used only if the directory is a real
+    directory (not a symlink) owned by the current user and inaccessible to anyone else.
+    """
+    try:
+        os.makedirs(_PARSE_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(_PARSE_CACHE_DIR)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def load_app_conf(path):
+    """
+    Set `ZOMBIE_NGINX_CACHE=1` to keep parsed configs in `_PARSE_CACHE_DIR`, keyed by SHA-256 of the file contents,
+    so that re-runs with an unchanged file skip YAML parsing.
+    """
+    with open(path, 'rb') as config_yml:
+        data = config_yml.read()
+    if os.environ.get('ZOMBIE_NGINX_CACHE') != '1' or not _parse_cache_dir_is_trusted():
+        return parse_app_conf(data)
+
+    cache_path = os.path.join(_PARSE_CACHE_DIR, hashlib.sha256(data).hexdigest() + '.pkl')
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        pass  # missing or unreadable entry, parse again
+
+    app_conf = parse_app_conf(data)
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=_PARSE_CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(app_conf, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        # caching is best-effort
+    return app_conf
+
+
+def write_stdout(text):
+    """
+    Writes `text` to the stdout file descriptor as a single UTF-8 buffer, bypassing the `sys.stdout` text wrapper.
+    Falls back to `sys.stdout.write()` when stdout was replaced with a stream that has no file descriptor.
+    """
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        sys.stdout.write(text)
+        return
+    sys.stdout.flush()
+    view = memoryview(text.encode('utf-8'))
+    while view:
+        view = view[os.write(fd, view):]
+
+
 def main():
     try:
-        with open(sys.argv[1]) as config_yml:
-            app_conf = yaml.safe_load(config_yml)
+        app_conf = load_app_conf(sys.argv[1])
     except FileNotFoundError:
-        print(sys.stderr, f'This image requires {sys.argv[1]} to be present. Did you forget to docker-mount it?')
+        sys.stderr.write(f'This image requires {sys.argv[1]} to be present. Did you forget to docker-mount it?\n')
         sys.exit(1)
 
     upstreams_conf, upstreams_data = parse_upstreams(app_conf)
@@ -402,7 +594,9 @@ def main():
     http.extend(servers_conf)
     nginx_conf = _NGINX_GLOBALS.copy()
     nginx_conf.append(('http', http))
-    emit_nginx_conf(nginx_conf)
+    output = io.StringIO()
+    emit_nginx_conf(nginx_conf, output)
+    write_stdout(output.getvalue())
 
 
 if __name__ == '__main__':